@@ -18,8 +18,18 @@ For more information, visit: https://anchain.ai
 
 import os
 import sys
-import requests
+import httpx
+import ijson
+import orjson
+import atexit
+import asyncio
+import hashlib
+import inspect
 import argparse
+import functools
+from threading import Lock
+from dataclasses import dataclass
+from cachetools import TTLCache
 from typing import Literal
 from fastmcp import FastMCP
 from fastmcp.server.dependencies import get_http_headers
@@ -28,12 +38,152 @@ from fastmcp.exceptions import FastMCPError, ValidationError, NotFoundError
 # Create an MCP server
 mcp = FastMCP("anchain_aml")
 url = "https://aml.anchainai.com/api"
+# endpoints, relative to the client's base_url
+_EP_CRYPTO = '/crypto_screening'
+_EP_SANCTIONS = '/sanctions_screening'
+_EP_IP = '/ip_screening'
+_EP_TRACE = '/crypto_auto_trace'
+_EP_CONTRACT = '/smart_contract_agent'
+# fixed query params of the smart contract endpoint actions
+_GET_SRC_BASE = {'action': 'contract'}
+_GET_TX_BASE = {'action': 'transaction'}
+# seconds allowed for a multi-round auto_trace call before returning what has been collected
+TRACE_DEADLINE = 50
+# upper bound on auto_trace max_depth
+MAX_TRACE_DEPTH = 5
+# upper bound on the number of extra (billable) trace requests a single auto_trace call may send
+MAX_TRACE_REQUESTS = 100
 anchain_apikey = None
+_auth_headers = None
 remote = False
 
+class _RetryTransport(httpx.AsyncBaseTransport):
+    """Retry GET requests answered with a rate limit or gateway error, backing off exponentially.
+
+    POST requests are passed through untouched since they are not safe to replay.
+    """
+
+    def __init__(self, transport, retries=3, backoff_factor=0.2, status_forcelist=(429, 502, 503, 504)):
+        self._transport = transport
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._status_forcelist = status_forcelist
+
+    async def handle_async_request(self, request):
+        for attempt in range(self._retries + 1):
+            response = await self._transport.handle_async_request(request)
+            if request.method != 'GET' or response.status_code not in self._status_forcelist \
+                    or attempt == self._retries:
+                return response
+            await response.aclose()
+            await asyncio.sleep(self._backoff_factor * 2 ** attempt)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+# shared async client so concurrent tool calls multiplex over pooled HTTP/2 connections
+_client = httpx.AsyncClient(
+    base_url=url,
+    timeout=httpx.Timeout(30, connect=5),
+    transport=_RetryTransport(httpx.AsyncHTTPTransport(http2=True, retries=3,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50))),
+    headers={"User-Agent": "anchain-aml-mcp/1.0", "Accept-Encoding": "br, gzip, deflate"},
+)
+
+
+def _close_client():
+    try:
+        asyncio.run(_client.aclose())
+    except RuntimeError:
+        pass
+
+atexit.register(_close_client)
+
+def _tenant(headers):
+    """Short digest identifying the caller's apikey without keeping the secret around."""
+    return hashlib.blake2b(headers["Authorization"].encode(), digest_size=8).hexdigest()
+
+
+# short lived cache for idempotent lookups, partitioned by apikey so tenants never share results
+_cache = TTLCache(maxsize=4096, ttl=300)
+# transaction summaries and contract source code can be hundreds of KB each, so they get much smaller caches of their own
+_tx_cache = TTLCache(maxsize=64, ttl=300)
+_source_cache = TTLCache(maxsize=64, ttl=300)
+_cache_lock = Lock()
+
+
+class _Uncacheable(Exception):
+    """Carries a tool result that must reach the caller but not the cache."""
+
+    def __init__(self, result):
+        self.result = result
+
+
+def _cacheable(res, result):
+    """Return `result` for caching, or keep it out of the cache if `res` failed."""
+    if not res.is_success:
+        raise _Uncacheable(result)
+    return result
+
+
+def _cached(cache=_cache, when=None):
+    """Cache a read-only tool's result in `cache`, optionally only when `when(arguments)` is true.
+
+    The tool opts its result out of the cache by returning it through `_cacheable`.
+    """
+    def decorator(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = None
+            if not when or when(bound.arguments):
+                key = (fn.__name__, _tenant(check_apikey()), tuple(sorted(bound.arguments.items())))
+                with _cache_lock:
+                    if key in cache:
+                        return cache[key]
+
+            try:
+                result = await fn(*args, **kwargs)
+            except _Uncacheable as e:
+                return e.result
+            if key is not None:
+                with _cache_lock:
+                    cache[key] = result
+            return result
+        return wrapper
+    return decorator
+
+
+# requests currently in flight, so identical concurrent calls share one round-trip
+_inflight = {}
+
+
+async def _coalesce(key, fetch):
+    """Await `fetch()`, joining an identical request already in flight under `key`."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield so one caller cancelling does not cancel the request for the others
+    return await asyncio.shield(task)
+
+@_cached()
+async def _crypto(address, protocol, action):
+    """Shared crypto_screening call behind the score/activity/attribution tools."""
+    headers = check_apikey()
+    res = await _client.get(_EP_CRYPTO, params={'protocol': protocol, 'address': address, 'action': action},
+        headers=headers)
+    return _cacheable(res, orjson.loads(res.content))
+
+
 # Add an addition tool
 @mcp.tool()
-def crypto_screening(address: str, protocol: str) -> dict:
+async def crypto_screening(address: str, protocol: str) -> dict:
     """Basic risk assessment for cryptocurrency addresses.
 
     Args:
@@ -60,48 +210,36 @@ def crypto_screening(address: str, protocol: str) -> dict:
         zec     Zcash
 
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/crypto_screening', params={'protocol': protocol, 'address': address, 'action': 'score'}, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return res.json()
+    return await _crypto(address, protocol, 'score')
 
 
 # Add an addition tool
 @mcp.tool()
-def crypto_activity_screening(address: str, protocol: str) -> dict:
+async def crypto_activity_screening(address: str, protocol: str) -> dict:
     """Suspicious activity analysis for cryptocurrency addresses.
 
     Args:
         address: crypto address (e.g. 0xf4548503dd51de15e8d0e6fb559f6062d38667e7, bc1qxy2kgdygjrsqtzq2n0yrf2493p83kkfjhx0wlh)
         proto: 3-letter blockchain code of the crypto address (e.g. btc, eth, sol)
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/crypto_screening', params={'protocol': protocol, 'address': address, 'action': 'activity'}, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return res.json()
+    return await _crypto(address, protocol, 'activity')
 
 
 # Add an addition tool
 @mcp.tool()
-def crypto_attribution_screening(address: str, protocol: str) -> dict:
+async def crypto_attribution_screening(address: str, protocol: str) -> dict:
     """Transaction flow attribution for cryptocurrency addresses. (pro plans apikey only)
 
     Args:
         address: crypto address (e.g. 0xf4548503dd51de15e8d0e6fb559f6062d38667e7, bc1qxy2kgdygjrsqtzq2n0yrf2493p83kkfjhx0wlh)
         proto: 3-letter blockchain code of the crypto address (e.g. btc, eth, sol)
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/crypto_screening', params={'protocol': protocol, 'address': address, 'action': 'attribution'}, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return res.json()
+    return await _crypto(address, protocol, 'attribution')
 
 
 # Add an addition tool
 @mcp.tool()
-def sanctions_screening(schema: str='person', scope: str='basic', name: list[str]=None, idNumber: list[str]=None, nationality: list[str]=None, birthYear: list[str]=None) -> dict:
+async def sanctions_screening(schema: str='person', scope: str='basic', name: list[str]=None, idNumber: list[str]=None, nationality: list[str]=None, birthYear: list[str]=None) -> dict:
     """Check individuals or entities against global sanctions lists.
 
     Args:
@@ -118,46 +256,45 @@ def sanctions_screening(schema: str='person', scope: str='basic', name: list[str
         - Array elements within each condition are combined with OR logic
     """
 
-    apikey = check_apikey()
+    if not any((name, idNumber, nationality, birthYear)):
+        raise ValidationError("at least one of name/idNumber/nationality/birthYear required")
+    headers = check_apikey()
     payload = {
         "schema": schema,
         "scope": scope,
-        "properties": {}
+        "properties": {k: v for k, v in (('name', name), ('idNumber', idNumber),
+            ('nationality', nationality), ('birthYear', birthYear)) if v}
     }
-    if name:
-        payload['properties'].update({'name': name})
-    if idNumber:
-        payload['properties'].update({'idNumber': idNumber})
-    if nationality:
-        payload['properties'].update({'nationality': nationality})
-    if birthYear:
-        payload['properties'].update({'birthYear': birthYear})
 
-    data = requests.post(url=url+"/sanctions_screening", json=payload, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return data.json()
+    async def fetch():
+        data = await _client.post(_EP_SANCTIONS, json=payload,
+            headers=headers)
+        return orjson.loads(data.content)
+
+    key = ('sanctions_screening', _tenant(headers), orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))
+    return await _coalesce(key, fetch)
 
 
 # Add an addition tool
 @mcp.tool()
-def ip_screening(ip_address: str) -> dict:
+@_cached()
+async def ip_screening(ip_address: str) -> dict:
     """Check if an IP address originates from a sanctioned country.
 
     Args:
         ip_address: The IP address to check (IPv4 or IPv6)
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/ip_screening', params={'ip_address': ip_address}, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return res.json()
+    headers = check_apikey()
+    res = await _client.get(_EP_IP, params={'ip_address': ip_address},
+        headers=headers)
+    return _cacheable(res, orjson.loads(res.content))
 
 
 # Add an addition tool
 @mcp.tool()
-def auto_trace(protocol: str, time_from: int, time_to: int, address: str=None, txn_hash: str=None, 
-    direction: str='in',time_window: int=365, min_amount: int=0, max_amount: int=None, token: str=None) -> dict:
+async def auto_trace(protocol: str, time_from: int, time_to: int, address: str=None, txn_hash: str=None, 
+    direction: str='in',time_window: int=365, min_amount: int=0, max_amount: int=None, token: str=None,
+    max_depth: int=1, max_workers: int=8) -> dict:
     """Trace the asset flow originated from or ended at a blockchain address or from a transaction. 
 
     Args:
@@ -171,6 +308,8 @@ def auto_trace(protocol: str, time_from: int, time_to: int, address: str=None, t
         min_amount: minimun transaction amount to be included.(default: 0).
         max_amaount: maximum amount to be included.
         token: token currency (address) to trace for EVM blockchains.
+        max_depth: number of trace rounds, 1 to 5 (default: 1). above 1, extendable nodes of each round are traced again from their transaction hash and merged into the result.
+        max_workers: maximum number of concurrent trace requests when max_depth > 1 (default: 8).
 
     Return:
         - token_mapping: use this mapping to map address in path_info for tokens (if any)
@@ -183,8 +322,17 @@ def auto_trace(protocol: str, time_from: int, time_to: int, address: str=None, t
             state: the condition of this node (whether it can be extended by starting another trace request from this node)
             timestamp: the time of this transaction.
             vol: the amount of this transaction 
+        - truncated: only present (true) when extended tracing stopped at the time or request limit before reaching max_depth.
+        - errors: only present when some extended traces failed, a list of {hash, error} for the nodes whose branch is missing from path_info.
     """
 
+    if not address and not txn_hash:
+        raise ValidationError("address or txn_hash required")
+    if not 1 <= max_depth <= MAX_TRACE_DEPTH:
+        raise ValidationError(f"max_depth must be between 1 and {MAX_TRACE_DEPTH}")
+    if max_workers < 1:
+        raise ValidationError("max_workers must be at least 1")
+
     payload = {
         'proto': protocol,
         'direct': direction,
@@ -194,42 +342,123 @@ def auto_trace(protocol: str, time_from: int, time_to: int, address: str=None, t
         'min_amount': min_amount,
     }
     if address:
-        payload.update({'address': address})
+        payload['address'] = address
     else:
-        payload.update({'txnhash': txn_hash})
-    
-    if max_amount:
-        payload.update({'max_amount': max_amount})
-    if token:
-        payload.update({'token': token})
+        payload['txnhash'] = txn_hash
+    payload.update({k: v for k, v in (('max_amount', max_amount), ('token', token)) if v})
+
+    headers = check_apikey()
+    # the time limit covers the whole tool call, including this first trace
+    deadline = asyncio.get_running_loop().time() + TRACE_DEADLINE
+    result = await _trace(payload, headers)
+    if max_depth > 1:
+        await _extend_trace(result, payload, headers, max_depth, max_workers, deadline)
+    return result
+
+
+async def _trace(payload, headers):
+    res = await _client.post(_EP_TRACE, json=payload, headers=headers)
+    return orjson.loads(res.content)
+
+
+def _node_key(node):
+    # utxo transactions show up as several nodes sharing one hash
+    return (node.get('hash'), node.get('sender'), node.get('receiver'))
+
 
-    apikey = check_apikey()
-    res = requests.post(url=url+'/crypto_auto_trace', json=payload, headers={
-        "Authorization": f"Bearer {apikey}"
-    })
-    return res.json()
+async def _extend_trace(result, payload, headers, max_depth, max_workers, deadline):
+    """Trace extendable nodes of `result` concurrently, round by round, merging the new nodes into it.
+
+    Stops at `deadline`, an event loop time, or once MAX_TRACE_REQUESTS child traces were sent,
+    and marks the result as truncated.
+    """
+    # error bodies may not be objects at all, e.g. a bare "Unauthorized"
+    if not isinstance(result, dict) or not isinstance(result.get('path_info'), list):
+        return
+    path_info = result['path_info']
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_workers)
+    base = {k: v for k, v in payload.items() if k not in ('address', 'txnhash')}
+    seen = {_node_key(node) for node in path_info}
+    traced = {payload.get('txnhash')}
+    frontier = path_info
+    budget = MAX_TRACE_REQUESTS
+
+    async def trace_from(node):
+        async with semaphore:
+            return await _trace(base | {'txnhash': node['hash']}, headers)
+
+    for _ in range(max_depth - 1):
+        nodes = {node['hash']: node for node in frontier if node.get('state') and node.get('hash') not in traced}
+        if not nodes:
+            break
+        if len(nodes) > budget:
+            # out of request budget, trace what it still allows and stop after this round
+            result['truncated'] = True
+            nodes = dict(list(nodes.items())[:budget])
+            if not nodes:
+                break
+        budget -= len(nodes)
+        traced.update(nodes)
+        tasks = {asyncio.ensure_future(trace_from(node)): node for node in nodes.values()}
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=max(deadline - loop.time(), 0))
+        finally:
+            # also reached when the tool call itself is cancelled
+            for task in tasks:
+                task.cancel()
+
+        frontier = []
+        for task in done:
+            parent = tasks[task]
+            if task.exception():
+                exc = task.exception()
+                result.setdefault('errors', []).append({'hash': parent['hash'], 'error': f"{type(exc).__name__}: {exc}"})
+                continue
+            sub = task.result()
+            if not isinstance(sub, dict) or not isinstance(sub.get('path_info'), list):
+                result.setdefault('errors', []).append({'hash': parent['hash'], 'error': sub})
+                continue
+            for node in sub['path_info']:
+                if _node_key(node) in seen:
+                    continue
+                seen.add(_node_key(node))
+                node['depth'] = node.get('depth', 0) + parent.get('depth', 0)
+                path_info.append(node)
+                frontier.append(node)
+            for mapping in ('labels_mapping', 'token_mapping'):
+                if isinstance(sub.get(mapping), dict):
+                    result.setdefault(mapping, {}).update(sub[mapping])
+
+        if pending:
+            result['truncated'] = True
+        if result.get('truncated'):
+            break
 
 
 # Add an addition tool
 @mcp.tool()
-def get_source_code(address: str, protocol: Literal['eth', 'bnb']) -> dict:
+@_cached(_source_cache)
+async def get_source_code(address: str, protocol: Literal['eth', 'bnb']) -> dict:
     """Get smart contract source code (if any) by address.
 
     Args:
         address: smart contract address
         protocol: blockchain protocol of the smart contract address (only support 'eth' and 'bnb')
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/smart_contract_agent', 
-        params={'action': 'contract', 'protocol': protocol, 'contract_address': address}, 
-        headers={"Authorization": f"Bearer {apikey}"}
+    headers = check_apikey()
+    res = await _client.get(_EP_CONTRACT, 
+        params=_GET_SRC_BASE | {'protocol': protocol, 'contract_address': address}, 
+        headers=headers
     )
-    return res.json()
+    return _cacheable(res, orjson.loads(res.content))
 
 
 # Add an addition tool
 @mcp.tool()
-def get_transaction(transaction_hash: str, protocol: Literal['eth', 'bnb'], scope: str='summary') -> dict:
+@_cached(_tx_cache, when=lambda args: args['scope'] == 'summary')
+async def get_transaction(transaction_hash: str, protocol: Literal['eth', 'bnb'], scope: str='summary') -> dict:
     """Get transaction data by transaction hash. options: summarized analysis or detailed execution flow. use in caution: requesting full scope data can cost high token usage or hit the max token limit.
 
     Args:
@@ -287,39 +516,79 @@ def get_transaction(transaction_hash: str, protocol: Literal['eth', 'bnb'], scop
                 "calls": [<internal call objects during execution of this call>]
             }
     """
-    apikey = check_apikey()
-    res = requests.get(url=url+'/smart_contract_agent', 
-        params={'action': 'transaction', 'protocol': protocol, 'transaction_hash': transaction_hash}, 
-        headers={"Authorization": f"Bearer {apikey}"}
-    )
+    headers = check_apikey()
+    async with _client.stream('GET', _EP_CONTRACT, 
+        params=_GET_TX_BASE | {'protocol': protocol, 'transaction_hash': transaction_hash}, 
+        headers=headers
+    ) as res:
+        if scope == 'summary':
+            result = await _parse_summary(res)
+        else:
+            # the execution flow is wanted here, orjson on the buffered body is several times faster than ijson
+            result = orjson.loads(await res.aread())
     # this is to cut down return size
-    result = res.json()
     try:
         result = result['data']['transaction']
-        if scope == 'summary':
-            result.pop('data')
-        elif scope == 'full':
+        if scope == 'full':
             result = result.pop('data')
-    except:
+    except (KeyError, TypeError):
         pass
-    return result
+    return _cacheable(res, result)
+
+
+class _AsyncStream:
+    """Async file-like view of a streamed response body, as consumed by ijson."""
+
+    def __init__(self, res):
+        self._chunks = res.aiter_bytes()
+
+    async def read(self, size=-1):
+        # ijson probes with read(0) to detect bytes vs str
+        if size == 0:
+            return b''
+        return await anext(self._chunks, b'')
+
+
+async def _parse_summary(res):
+    """Build the response while streaming it, never materializing the execution flow in data.transaction.data."""
+    skip = 'data.transaction.data'
+    builder = ijson.ObjectBuilder()
+    async for prefix, event, value in ijson.parse_async(_AsyncStream(res), use_float=True):
+        if prefix == skip or prefix.startswith(skip + '.') \
+                or (prefix == 'data.transaction' and event == 'map_key' and value == 'data'):
+            continue
+        builder.event(event, value)
+    return builder.value
 
 
 def check_apikey():
-    if remote:
-        apikey = get_http_headers().get("x-api-key", "")
-    else:
-        apikey = anchain_apikey
-    
-    if not apikey:
+    """Return the Authorization headers for the current caller."""
+    if not remote:
+        # stdio mode has a single fixed key, its headers are built once in main()
+        if not _auth_headers:
             raise ValidationError("no anchain apikey provided")
-    return apikey
+        return _auth_headers
+
+    apikey = get_http_headers().get("x-api-key", "")
+    if not apikey:
+        raise ValidationError("no anchain apikey provided")
+    return {"Authorization": f"Bearer {apikey}"}
 
-def main():
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Parsed command line options."""
+    remote: bool
+    host: str
+    port: int
+    apikey: str | None
+
+
+@functools.cache
+def _get_parser():
     parser = argparse.ArgumentParser()
 
     # Mode selection
-    parser.add_argument('--rm', '--remote', action='store_true', 
+    parser.add_argument('--rm', '--remote', dest='remote', action='store_true', 
                        help='Run in remote mode')
 
     # http server arguments
@@ -333,23 +602,27 @@ def main():
     local_group = parser.add_argument_group('stdio server options')
     local_group.add_argument('-k', '--ANCHAIN_APIKEY', dest='apikey',
                             help='API key for stdio server')
+    return parser
+
 
-    args = parser.parse_args()
+def main(argv=None):
+    cfg = Config(**vars(_get_parser().parse_args(argv)))
 
-    if args.rm:
+    if cfg.remote:
         global remote
         remote = True
-        mcp.run(transport="http", host=args.host, port=args.port)
+        mcp.run(transport="http", host=cfg.host, port=cfg.port)
     else:
-        global anchain_apikey
-        if args.apikey:
-            anchain_apikey = args.apikey
+        global anchain_apikey, _auth_headers
+        if cfg.apikey:
+            anchain_apikey = cfg.apikey
         else:
             anchain_apikey = os.environ.get("ANCHAIN_APIKEY")
     
         if not anchain_apikey:
             print('ANCHAIN_APIKEY environment variable is required', file=sys.stderr, flush=True)
             raise ValueError('ANCHAIN_APIKEY environment variable is required')
+        _auth_headers = {"Authorization": f"Bearer {anchain_apikey}"}
     
         mcp.run()
 